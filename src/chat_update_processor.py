@@ -0,0 +1,54 @@
+"""
+This module provides the update processor used by the Telegram bot application.
+
+Updates from different chats are processed concurrently, so a long video download in one chat
+does not delay any other chat. Updates from the same chat are processed one after another in the
+order they were received, so replies in a chat never overtake each other.
+
+Dependencies:
+- telegram: For the update processor extension point of the bot application.
+"""
+
+import asyncio
+import weakref
+from typing import Awaitable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across chats while keeping the order of updates within a chat."""
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = 1024):
+        # The base class limit is taken before the chat lock, so it only caps the updates waiting in all chats.
+        # Updates queued behind their own chat must not hold slots of the limit on processing
+        super().__init__(max_pending_updates)
+        self._processing_semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # One lock per chat with pending updates, dropped automatically once no update holds it
+        self._chat_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat_id = self._get_chat_id(update)
+        if chat_id is None:
+            async with self._processing_semaphore:
+                await coroutine
+            return
+
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[chat_id] = lock
+        async with lock, self._processing_semaphore:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _get_chat_id(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
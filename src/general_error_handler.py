@@ -11,11 +11,13 @@ Dependencies:
 """
 
 import os
+import asyncio
 from telegram import Update
 from telegram.ext import ContextTypes
 from logger import error, debug
 
-admins_chat_ids = os.getenv("ADMINS_CHAT_IDS")
+# Parsed once at import, not on every error
+admins_chat_ids = tuple(x.strip() for x in os.getenv("ADMINS_CHAT_IDS", "").split(",") if x.strip())
 send_error_to_admin = os.getenv("SEND_ERROR_TO_ADMIN", "False").lower() == "true"
 
 
@@ -35,13 +37,22 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     debug("Update %s caused error %s", update, context.error)
     debug("send_error_to_admin: %s, admin_chat_id: %s", send_error_to_admin, admins_chat_ids)
     if send_error_to_admin and admins_chat_ids:
-        admin_ids = admins_chat_ids.split(",")  # Split the string into a list of IDs
-        for admin_chat_id in admin_ids:
-            await context.bot.send_message(
-                chat_id=admin_chat_id.strip(),  # Strip any whitespace
-                text=f"`{context.error}` \n\nWho triggered the error: `@{username}`.\nUrl was {update.message.text}",
-                disable_web_page_preview=True,
-                parse_mode='Markdown',
-            )
+        text = f"`{context.error}` \n\nWho triggered the error: `@{username}`.\nUrl was {update.message.text}"
+        # Notify all admins at once, a failed notification must not stop the others
+        results = await asyncio.gather(
+            *(
+                context.bot.send_message(
+                    chat_id=admin_chat_id,
+                    text=text,
+                    disable_web_page_preview=True,
+                    parse_mode='Markdown',
+                )
+                for admin_chat_id in admins_chat_ids
+            ),
+            return_exceptions=True,
+        )
+        for admin_chat_id, result in zip(admins_chat_ids, results):
+            if isinstance(result, Exception):
+                error("Failed to send error message to admin %s: %s", admin_chat_id, result)
     else:
         debug("Admin chat IDs are not set; error message not sent to admins.")
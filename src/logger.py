@@ -14,9 +14,10 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = frozenset({"debug", "info", "warning", "error", "critical"})
 
 # Check if the LOG_LEVEL is correct
-if LOG_LEVEL.lower() not in ["debug", "info", "warning", "error", "critical"]:
+if LOG_LEVEL.lower() not in LOG_LEVELS:
     logger.warning("LOG_LEVEL is not correct. Defaulting to INFO")
     LOG_LEVEL = "INFO"
 else:
@@ -1,22 +1,40 @@
 """Download videos from tiktok, x(twitter), reddit, youtube shorts, instagram reels and many more"""
 
 import os
+import re
 import random
 import json
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from cachetools import TTLCache
 from dotenv import load_dotenv
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows, the default asyncio loop is used there
+    uvloop = None
 from telegram import Update
-from telegram.error import TimedOut, NetworkError, TelegramError
-from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, TimedOut, NetworkError, TelegramError
+from telegram.ext import AIORateLimiter, Application, MessageHandler, filters, ContextTypes
 from telegram.constants import MessageEntityType
 from logger import error, info, debug
 from general_error_handler import error_handler
-from permissions import inform_user_not_allowed, is_user_or_chat_not_allowed, supported_sites
+from chat_update_processor import PerChatUpdateProcessor
+from permissions import inform_user_not_allowed, is_user_or_chat_not_allowed, is_supported_url
 from video_utils import (
+    COMPRESSION_WORKERS,
+    DOWNLOAD_TIMEOUT,
     compress_video,
     download_video,
+    get_video_duration,
     cleanup,
-    is_video_duration_over_limits,
+    cleanup_orphaned_temp_dirs,
+    create_temp_dir,
+    preload_extractors,
     is_video_too_long_to_download,
 )
 
@@ -35,18 +53,102 @@ def load_responses():
     try:
         with open(filename, "r", encoding="utf-8") as file:
             data = json.load(file)
-            return data["responses"]
+            return tuple(data["responses"])
     except FileNotFoundError:
         # Return a minimal set of responses if no response files found
         not_found_responses = {
             "en": "Sorry, I'm having trouble loading my responses right now! 😅",
             "ua": "Вибачте, у мене проблеми із завантаженням відповідей! 😅",
         }
-        return not_found_responses[language]
+        # A one-item tuple, random.choice on a bare string would pick a single character
+        return (not_found_responses.get(language, not_found_responses["en"]),)
 
 
 responses = load_responses()
 
+# Optional self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api) started with --local,
+# e.g. http://localhost:8081. Videos are then passed to it as local file paths instead of being uploaded
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+
+# Telegram accepts bot uploads up to 50MB, a self-hosted Bot API server in local mode up to 2000MB
+UPLOAD_LIMIT_MB = 2000 if BOT_API_URL else 50
+
+# Longest video sent, in seconds
+MAX_DURATION = 12 * 60
+
+# User-facing messages resolved once for the configured language
+NOT_SUPPORTED_MSG = (
+    "Цей сайт не підтримується. Спробуйте додати ** перед https://"
+    if language == "ua"
+    else "This site is not supported. Try adding ** before the https://"
+)
+TOO_LONG_MSG = (
+    f"Відео задовге для відправки (понад {MAX_DURATION // 60} хвилин)."
+    if language == "ua"
+    else f"The video is too long to send (over {MAX_DURATION // 60} minutes)."
+)
+TOO_LARGE_MSG = (
+    f"Відео завелике для відправки (понад {UPLOAD_LIMIT_MB}MB)."
+    if language == "ua"
+    else f"The video is too large to send (over {UPLOAD_LIMIT_MB}MB)."
+)
+
+# Precompiled once so every message is scanned in a single pass
+BOT_MENTION_RE = re.compile(r"(?<!\S)(?:ботяра|bot_health)(?!\S)", re.IGNORECASE)
+# A link, optionally forced with "**" right before it ("** https://" works too)
+URL_RE = re.compile(r"(?:\*\*\s*)?https?://\S+", re.IGNORECASE)
+
+# Bounded pool for blocking work (yt-dlp, ffprobe, file system) so the event loop keeps serving other chats
+MAX_WORKERS = 4
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Separate pool for ffmpeg compression, sized to the CPUs so parallel encodes don't oversubscribe them
+compression_executor = ThreadPoolExecutor(max_workers=COMPRESSION_WORKERS)
+
+
+async def run_blocking(func, *args, pool: Executor = executor):
+    """
+    Runs a blocking function in a bounded worker pool without blocking the event loop.
+
+    Args:
+        func (callable): The blocking function to run.
+        *args: Positional arguments passed to `func`.
+        pool (Executor): The pool to run `func` in (default is the general worker pool).
+
+    Returns:
+        The return value of `func`.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, func, *args)
+
+
+# Seconds Telegram holds a getUpdates request open while waiting for new updates
+POLLING_TIMEOUT = 50
+
+# Maximum number of updates handled at the same time
+CONCURRENT_UPDATES = 32
+
+# Limits how many videos are downloaded and processed at once across all chats
+download_semaphore = asyncio.Semaphore(MAX_WORKERS)
+
+# Download directories not in use by this process and untouched for this long are leftovers: far past the
+# download deadline, so even another instance sharing the directory has given up on them. The sweep runs
+# every few minutes
+STALE_TEMP_DIR_AGE = 30 * DOWNLOAD_TIMEOUT
+TEMP_DIR_SWEEP_INTERVAL = 10 * 60
+
+# Download directories in use by this process, skipped by the sweep however long they take
+active_temp_dirs = set()
+
+# Telegram file_id of already sent videos by URL, a repeated link is re-sent without uploading it again
+video_file_ids = TTLCache(maxsize=2048, ttl=24 * 60 * 60)
+
+# URLs being downloaded right now, set once the download and upload are done
+in_flight_urls = {}
+
+# (chat_id, URL) pairs seen in the last seconds, used to ignore repeated links
+recent_requests = TTLCache(maxsize=1024, ttl=30)
+
 
 def spoiler_in_message(entities):
     """
@@ -70,25 +172,7 @@ def spoiler_in_message(entities):
         ]
         spoiler_in_message(entities)  # Returns: True
     """
-    if entities:
-        for entity in entities:
-            if entity.type == MessageEntityType.SPOILER:
-                return True
-    return False
-
-
-def is_bot_mentioned(message_text: str) -> bool:
-    """
-    Checks if the bot is mentioned in the message text.
-
-    Args:
-        message_text (str): The text of the message to check.
-
-    Returns:
-        bool: True if the bot is mentioned, False otherwise.
-    """
-    bot_trigger_words = ["ботяра", "bot_health"]
-    return any(word in message_text.lower().split() for word in bot_trigger_words)
+    return bool(entities) and any(entity.type is MessageEntityType.SPOILER for entity in entities)
 
 
 def clean_url(message_text: str) -> str:
@@ -101,24 +185,28 @@ def clean_url(message_text: str) -> str:
     Returns:
         str: The cleaned URL.
     """
-    return message_text.replace("**", "") if message_text.startswith("**") else message_text
+    # Only the leading force-download marker is dropped, "**" inside the URL is kept
+    return message_text.removeprefix("**").lstrip()
 
 
-def is_large_file(file_path: str, max_size_mb: int = 50) -> bool:
+def is_large_file(file_path: str, max_size_mb: int = UPLOAD_LIMIT_MB) -> bool:
     """
     Checks if the file size exceeds the specified maximum size.
 
     Args:
         file_path (str): The path to the file to check.
-        max_size_mb (int): The maximum file size in megabytes (default is 50MB).
+        max_size_mb (int): The maximum file size in megabytes (default is the Bot API upload limit).
 
     Returns:
         bool: True if the file size exceeds the maximum size, False otherwise.
     """
-    return os.path.exists(file_path) and (os.path.getsize(file_path) / (1024 * 1024)) > max_size_mb
+    try:
+        return os.stat(file_path).st_size > max_size_mb * 1024 * 1024
+    except OSError:
+        return False
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):  # pylint: disable=unused-argument
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handles incoming messages from the Telegram bot.
 
@@ -131,23 +219,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):  #
         update (telegram.Update): Represents the incoming update from the Telegram bot.
         context (ContextTypes.DEFAULT_TYPE): The context object for the handler.
 
+    Only messages with a link reach this handler, bot mentions are handled by `handle_bot_mention`.
+
     Behavior:
-        - If the message contains "ботяра" (case insensitive), responds with a random response
-          from a predefined list of bot responses.
         - If the message contains an Instagram Stories URL, informs the user that downloading is not supported.
-        - If the message contains a supported URL
+        - For every supported URL in the message
           (Instagram Reels, Facebook Reels, YouTube Shorts,
-          TikTok, Reddit, X/Twitter):
+          TikTok, Reddit, X/Twitter), processed concurrently:
             - Downloads and optionally compresses the video.
             - Sends the video back to the user via Telegram.
             - Preserves any spoiler tags present in the original message.
-            - Cleans up temporary files after sending the video.
+            - Removes the temporary download directory afterwards, even on errors.
         - Handles error cases with appropriate user feedback, ensuring a smooth user experience.
 
     Returns:
         None
     """
-    video_path = None
     if not update.message or not update.message.text:
         return
 
@@ -155,77 +242,185 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):  #
 
     message_text = update.message.text.strip()
 
-    # Handle bot mention response
-    if is_bot_mentioned(message_text):
-        await respond_with_bot_message(update)
-        return
-
-    # Ignore if message doesn't contain http
-    if "http" not in message_text:
-        return
-
     # Check if user is not allowed
     if is_user_or_chat_not_allowed(update.effective_user.username, update.effective_chat.id):
         await inform_user_not_allowed(update)
         return
 
-    message_text = message_text.replace("** ", "**")
+    # Keep the links from supported sites (or forced with **), without duplicates
+    links = URL_RE.findall(message_text) + [
+        entity.url for entity in update.message.entities if entity.type is MessageEntityType.TEXT_LINK
+    ]
+    urls = list(dict.fromkeys(clean_url(link) for link in links if is_supported_url(link)))
+    debug("Supported URLs in message: %s", urls)
 
     # Check if URL is from a supported site. Ignore if it's from a group or channel
-    if not any(site in message_text for site in supported_sites):
+    if not urls:
         if update.effective_chat.type == "private":
-            not_supported_responses = {
-                "ua": "Цей сайт не підтримується. Спробуйте додати ** перед https://",
-                "en": "This site is not supported. Try adding ** before the https://",
-            }
-            await update.message.reply_text(not_supported_responses[language])
+            await update.message.reply_text(NOT_SUPPORTED_MSG)
             return  # Stop further execution after sending the reply
         return
 
-    debug("Cleaning URL from message text.")
-    url = clean_url(message_text)
-    debug("Cleaned URL: %s", url)
-
-    if is_video_too_long_to_download(url):
-        debug("Video is too long to process.")
-        await update.message.reply_text("The video is too long to send (over 12 minutes).")
+    # Drop links this chat already sent moments ago (double paste, client resend)
+    chat_id = update.effective_chat.id
+    urls = [url for url in urls if (chat_id, url) not in recent_requests]
+    if not urls:
+        debug("Ignoring repeated links in chat %s", chat_id)
         return
-    debug("Video is not too long or metadata is not available. Starting download.")
+    for url in urls:
+        recent_requests[(chat_id, url)] = True
+
+    # Check for spoiler flag
+    has_spoiler = spoiler_in_message(update.message.entities)
+
+    # Process every link of the message concurrently, the semaphore bounds the total number of downloads.
+    # A failing link must not abort the others, so failures are collected once all are done and passed
+    # to the error handlers, which notify the admins
+    results = await asyncio.gather(*(process_url(update, url, has_spoiler) for url in urls), return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            error("Processing %s failed: %s", url, result, exc_info=result)
+            await context.application.process_error(update, result)
+
+
+async def process_url(update: Update, url: str, has_spoiler: bool) -> None:
+    """
+    Downloads a single video URL, compresses it if needed and sends it to the chat.
+
+    If the same URL is already being processed for another message, waits for that to finish first,
+    so the video is then re-sent by its file_id instead of being downloaded twice. If that fails, one
+    of the waiting requests downloads it instead.
+
+    Args:
+        update (telegram.Update): Represents the incoming update from the Telegram bot.
+        url (str): The cleaned URL of the video to download.
+        has_spoiler (bool): Indicates if the message contains a spoiler.
+
+    Returns:
+        None
+    """
+    # Wait until the video was sent or nobody else is downloading it. When an owner fails, all waiters
+    # wake up, the first one to run takes over and the others wait for it in turn
+    while (in_flight := in_flight_urls.get(url)) is not None and url not in video_file_ids:
+        debug("Waiting for the download in progress of URL: %s", url)
+        await in_flight.wait()
+    is_owner = in_flight is None
+    if is_owner:
+        in_flight = in_flight_urls[url] = asyncio.Event()
 
     try:
-        video_path = download_video(url)
+        async with download_semaphore:
+            await download_and_send(update, url, has_spoiler)
+    finally:
+        if is_owner:
+            del in_flight_urls[url]
+            in_flight.set()
+
+
+async def download_and_send(update: Update, url: str, has_spoiler: bool) -> None:
+    """
+    Runs the download -> compress -> send -> cleanup flow for a single URL.
 
-        if video_path and os.path.isdir(video_path) and not os.listdir(video_path):
-            debug("No videos in temporary directory: %s. Cleaning up.", video_path)
+    Args:
+        update (telegram.Update): Represents the incoming update from the Telegram bot.
+        url (str): The cleaned URL of the video to download.
+        has_spoiler (bool): Indicates if the message contains a spoiler.
+
+    Returns:
+        None
+    """
+    # A video sent before is re-sent by its file_id, skipping download, compression and upload
+    file_id = video_file_ids.get(url)
+    if file_id:
+        if await send_cached_video(update, file_id, has_spoiler):
+            debug("Sent cached video for URL: %s", url)
             return
+        video_file_ids.pop(url, None)
+
+    if await run_blocking(is_video_too_long_to_download, url, MAX_DURATION // 60):
+        debug("Video is too long to process.")
+        await update.message.reply_text(TOO_LONG_MSG)
+        return
+    debug("Video is not too long or metadata is not available. Starting download.")
+
+    async with temporary_directory() as temp_dir:
+        video_path, duration = await run_blocking(download_video, url, temp_dir, MAX_DURATION)
 
         # Check if video was downloaded
-        if not video_path or not os.path.exists(video_path):
-            debug("Video download failed or file does not exist.")
+        if not video_path:
+            if duration and duration > MAX_DURATION:
+                # Skipped during the download, the duration probe had no answer for it
+                await update.message.reply_text(TOO_LONG_MSG)
+                return
+            debug("Video download failed or no video found in %s.", temp_dir)
             return
 
-        # Compress video if it's larger than 50MB
-        # do not process compression if video is too long
-        if is_video_duration_over_limits(video_path):
-            await update.message.reply_text("The video is too large to send (over 50MB).")
+        # Compress video if it's larger than the upload limit
+        # do not process compression if video is too long, the duration is reused for compression.
+        # yt-dlp usually reports it, the file is probed only when it did not
+        if not duration:
+            duration = await run_blocking(get_video_duration, video_path)
+        if duration and duration > MAX_DURATION:
+            await update.message.reply_text(TOO_LARGE_MSG)
             return
 
-        if is_large_file(video_path):
-            compress_video(video_path)
-            if is_large_file(video_path):
-                await update.message.reply_text("The video is too large to send (over 50MB).")
+        if await run_blocking(is_large_file, video_path):
+            compressed_size = await run_blocking(
+                compress_video, video_path, duration, UPLOAD_LIMIT_MB, pool=compression_executor
+            )
+            if compressed_size > UPLOAD_LIMIT_MB * 1024 * 1024:
+                await update.message.reply_text(TOO_LARGE_MSG)
                 return  # Stop further execution
 
-        # Check for spoiler flag
-        has_spoiler = spoiler_in_message(update.message.entities)
-
         # Send the video to the chat
-        await send_video(update, video_path, has_spoiler)
+        file_id = await send_video(update, video_path, has_spoiler)
+        if file_id:
+            video_file_ids[url] = file_id
+
+
+async def sweep_temp_dirs(context: ContextTypes.DEFAULT_TYPE) -> None:  # pylint: disable=unused-argument
+    """
+    Periodic job removing download directories that outlived any download, so temp space stays bounded.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context object of the job.
+
+    Returns:
+        None
+    """
+    await run_blocking(cleanup_orphaned_temp_dirs, STALE_TEMP_DIR_AGE, frozenset(active_temp_dirs))
+
 
+@asynccontextmanager
+async def temporary_directory():
+    """
+    Creates a temporary download directory that is removed on exit, even if the download or sending fails.
+
+    Yields:
+        str: The path to the temporary directory.
+    """
+    temp_dir = await run_blocking(create_temp_dir)
+    active_temp_dirs.add(temp_dir)
+    try:
+        yield temp_dir
     finally:
-        # Clean up temporary files
-        if video_path and os.path.exists(video_path):
-            cleanup(video_path)
+        await run_blocking(cleanup, temp_dir)
+        active_temp_dirs.discard(temp_dir)
+
+
+async def handle_bot_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):  # pylint: disable=unused-argument
+    """
+    Handles messages that mention the bot ("ботяра" or "bot_health", case insensitive).
+
+    Parameters:
+        update (telegram.Update): Represents the incoming update from the Telegram bot.
+        context (ContextTypes.DEFAULT_TYPE): The context object for the handler.
+
+    Returns:
+        None
+    """
+    debug("Received a bot mention: %s", update.message.text)
+    await respond_with_bot_message(update)
 
 
 async def respond_with_bot_message(update: Update) -> None:
@@ -246,7 +441,31 @@ async def respond_with_bot_message(update: Update) -> None:
     )
 
 
-async def send_video(update: Update, video_path: str, has_spoiler: bool) -> None:
+async def send_cached_video(update: Update, file_id: str, has_spoiler: bool) -> bool:
+    """
+    Sends a video that was already uploaded to Telegram by its file_id, no bytes are uploaded.
+
+    Args:
+        update (telegram.Update): Represents the incoming update from the Telegram bot.
+        file_id (str): The Telegram file_id of the previously sent video.
+        has_spoiler (bool): Indicates if the message contains a spoiler.
+
+    Returns:
+        bool: True if the video was sent, False if the file_id could not be used.
+
+    Raises:
+        telegram.error.TelegramError: When sending fails for another reason, e.g. a timeout.
+    """
+    try:
+        await update.message.chat.send_video(video=file_id, has_spoiler=has_spoiler, disable_notification=True)
+        return True
+    except BadRequest as e:
+        # Only a rejected file_id, after a timeout the video may already have been delivered
+        debug("Sending cached video failed, downloading it again: %s", e)
+        return False
+
+
+async def send_video(update: Update, video_path: str, has_spoiler: bool) -> Optional[str]:
     """
     Sends the video to the chat.
 
@@ -256,21 +475,29 @@ async def send_video(update: Update, video_path: str, has_spoiler: bool) -> None
         has_spoiler (bool): Indicates if the message contains a spoiler.
 
     Returns:
-        None
+        Optional[str]: The Telegram file_id of the sent video, or None if sending failed.
     """
+    if BOT_API_URL:
+        # In local mode the server reads the file itself, only its file:// path is sent
+        video = Path(video_path)
+    else:
+        # Read the file in the worker pool, a synchronous read of up to 50MB would stall the event loop
+        video = await run_blocking(Path(video_path).read_bytes)
     try:
-        with open(video_path, 'rb') as video_file:
-            await update.message.chat.send_video(
-                video=video_file,
-                has_spoiler=has_spoiler,
-                disable_notification=True,
-                write_timeout=8000,
-                read_timeout=8000,
-            )
+        message = await update.message.chat.send_video(
+            video=video,
+            filename=os.path.basename(video_path),
+            has_spoiler=has_spoiler,
+            disable_notification=True,
+            write_timeout=8000,
+            read_timeout=8000,
+        )
+        return message.video.file_id if message.video else None
     except TimedOut as e:
         error("Telegram timeout while sending video. %s", e)
     except (NetworkError, TelegramError) as e:
         await update.message.reply_text(f"Error sending video: {str(e)}. Please try again later.")
+    return None
 
 
 def main():
@@ -280,12 +507,16 @@ def main():
     This function initializes the bot, sets up message handling, and starts the bot's polling loop.
 
     Steps:
-        1. Retrieves the bot token from the environment variable `BOT_TOKEN`.
-        2. Builds a Telegram bot application using the `Application.builder()` method.
-        3. Adds a message handler to process all text messages (excluding commands) using the
-           `handle_message` function.
-        4. Prints a message to indicate the bot has started.
-        5. Starts the bot's polling loop, allowing it to listen for incoming updates until
+        1. Retrieves the bot token from the environment variable `BOT_TOKEN` and removes
+           temporary download directories left behind by a previous run.
+        2. Builds a Telegram bot application using the `Application.builder()` method with
+           updates processed concurrently across chats and in order within a chat, and outgoing
+           requests rate limited, optionally talking to a self-hosted Bot API server (`BOT_API_URL`).
+        3. Adds message handlers for text messages (excluding commands): bot mentions are answered by
+           `handle_bot_mention`, messages with a link are processed by `handle_message`.
+        4. Schedules a periodic sweep of stale temporary download directories.
+        5. Prints a message to indicate the bot has started.
+        6. Starts the bot's polling loop, allowing it to listen for incoming updates until
            manually stopped (Ctrl+C).
 
     Dependencies:
@@ -300,12 +531,34 @@ def main():
         None
     """
     bot_token = os.getenv("BOT_TOKEN")
-    application = Application.builder().token(bot_token).build()
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    if uvloop:
+        # libuv based event loop, lower per-callback and I/O overhead than the default one
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        debug("Using uvloop event loop")
+    cleanup_orphaned_temp_dirs(STALE_TEMP_DIR_AGE)
+    preload_extractors()
+    # Handle chats concurrently so a long download does not delay other chats, keeping the order within a chat
+    update_processor = PerChatUpdateProcessor(CONCURRENT_UPDATES)
+    # Throttle outgoing requests to the Bot API limits and retry after flood control instead of failing
+    rate_limiter = AIORateLimiter(max_retries=3)
+    builder = Application.builder().token(bot_token).concurrent_updates(update_processor).rate_limiter(rate_limiter)
+    if BOT_API_URL:
+        # A self-hosted server in local mode reads videos from disk and raises the size limit
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot").local_mode(True)
+        info("Using Bot API server at %s", BOT_API_URL)
+    application = builder.build()
+    # The filters drop every other message before a handler runs. Mentions go first, like before the split
+    # New messages only, the handlers read update.message, which is None for edits and channel posts
+    text_filter = filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND
+    link_filter = filters.Entity(MessageEntityType.URL) | filters.Entity(MessageEntityType.TEXT_LINK)
+    application.add_handler(MessageHandler(text_filter & filters.Regex(BOT_MENTION_RE), handle_bot_mention))
+    application.add_handler(MessageHandler(text_filter & link_filter, handle_message))
     # This handler will receive every error which happens in your bot
     application.add_error_handler(error_handler)
+    application.job_queue.run_repeating(sweep_temp_dirs, interval=TEMP_DIR_SWEEP_INTERVAL)
     info("Bot started. Ctrl+C to stop")
-    application.run_polling()
+    # Only plain messages are handled, a long poll timeout means fewer getUpdates calls while idle
+    application.run_polling(allowed_updates=[Update.MESSAGE], timeout=POLLING_TIMEOUT)
 
 
 if __name__ == "__main__":
@@ -5,11 +5,13 @@ the bot based on their Telegram usernames and chat IDs configured in environment
 
 import os
 from typing import Optional
+from urllib.parse import urlsplit
 from telegram import Update
 
-allowed_usernames = [x.strip() for x in os.getenv("ALLOWED_USERNAMES", "").split(",") if x]
-allowed_chat_ids = [int(x) for x in os.getenv("ALLOWED_CHAT_IDS", "").split(",") if x]
-limit_bot_access = os.getenv("LIMIT_BOT_ACCESS", "False")
+# Parsed once at import into sets, the checks below run on every message
+allowed_usernames = frozenset(x.strip() for x in os.getenv("ALLOWED_USERNAMES", "").split(",") if x)
+allowed_chat_ids = frozenset(int(x) for x in os.getenv("ALLOWED_CHAT_IDS", "").split(",") if x)
+limit_bot_access = os.getenv("LIMIT_BOT_ACCESS", "False") != "False"
 
 
 # Check if user or chat is not allowed. Returns True if not allowed, False if allowed
@@ -24,7 +26,7 @@ def is_user_or_chat_not_allowed(username: Optional[str], chat_id: int) -> bool:
         True if neither user nor chat is allowed, False if either is allowed
     """
     # default case when no limits are set
-    if limit_bot_access == "False":
+    if not limit_bot_access:
         return False
 
     # If chat_id is allowed, grant access regardless of username
@@ -57,12 +59,43 @@ async def inform_user_not_allowed(update: Update) -> None:
         )
 
 
-supported_sites = [
-    "**https://",
-    "facebook.com/",
-    "instagram.com/",
-    "tiktok.com/",
-    "reddit.com/",
-    "x.com/",
-    "youtube.com/shorts",
-]
+# Prefix that forces a download from any site supported by yt-dlp
+FORCE_DOWNLOAD_PREFIX = "**"
+
+# Supported domains mapped to the URL path prefix a link must start with on that domain
+supported_sites = {
+    "facebook.com": "/",
+    "instagram.com": "/",
+    "tiktok.com": "/",
+    "reddit.com": "/",
+    "x.com": "/",
+    "youtube.com": "/shorts",
+}
+
+
+def is_supported_url(url: str) -> bool:
+    """
+    Checks if the URL points to a supported site or is forced with the `**` prefix.
+
+    The URL is parsed once and its host (or a parent domain, so `www.`, `m.` and `vm.` subdomains
+    match too) is looked up in `supported_sites`, instead of searching the text for every site.
+
+    Args:
+        url (str): The URL to check, optionally prefixed with `**`.
+
+    Returns:
+        bool: True if the URL can be downloaded, False otherwise.
+    """
+    if url.startswith(FORCE_DOWNLOAD_PREFIX):
+        return True
+
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False  # Malformed URL, e.g. an unclosed IPv6 bracket
+    labels = (parts.hostname or "").split(".")
+    for i in range(len(labels) - 1):
+        path_prefix = supported_sites.get(".".join(labels[i:]))
+        if path_prefix is not None:
+            return parts.path.lower().startswith(path_prefix)
+    return False
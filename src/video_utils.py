@@ -1,13 +1,20 @@
 # pylint: disable=missing-module-docstring
 # pylint: disable=missing-function-docstring
 
+import copy
 import os
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+from functools import lru_cache
 import yt_dlp  # Ensure yt_dlp is installed and available
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from dotenv import load_dotenv
-from logger import debug, error
+from logger import debug, error, warning
 
 load_dotenv()  # Load environment variables from .env file
 
@@ -23,10 +30,109 @@ else:
     debug("INSTACOOKIES is False or cookies file not found")
 
 
+class YtDlpLogger:
+    """
+    Forwards in-process yt-dlp output to the bot logger instead of printing it to stdout.
+
+    Messages are passed as lazy `%s` arguments, so nothing is formatted below the active log level.
+    """
+
+    def debug(self, msg):
+        debug("yt-dlp: %s", msg)
+
+    def info(self, msg):
+        debug("yt-dlp: %s", msg)
+
+    def warning(self, msg):
+        warning("yt-dlp: %s", msg)
+
+    def error(self, msg):
+        error("yt-dlp: %s", msg)
+
+
+# Prefix of the per-download temporary directories, used to find leftovers of a crashed run
+TEMP_DIR_PREFIX = "dl_"
+
+# Base directory for downloads, system temporary directory by default. Can point to a tmpfs mount
+TEMP_DIR = os.getenv("TEMP_DIR") or None
+
+# Downloads go to a subdirectory the bot owns, so the leftover sweep never touches other programs' files
+DOWNLOAD_DIR = os.path.join(TEMP_DIR or tempfile.gettempdir(), "social_media_bot")
+
+# yt-dlp cache (YouTube signature functions and similar), ~/.cache/yt-dlp by default. Keep it on a volume
+# in containers, so it survives restarts
+YTDLP_CACHE_DIR = os.getenv("YTDLP_CACHE_DIR") or None
+
+# yt-dlp extractors of the supported sites, imported at start-up
+PRELOADED_EXTRACTORS = ("Facebook", "Instagram", "TikTok", "Reddit", "Twitter", "Youtube")
+
+# Recent metadata by URL. Info dicts can be large and their format URLs expire, so keep few and briefly
+metadata_cache = TTLCache(maxsize=128, ttl=10 * 60)
+metadata_lock = threading.Lock()
+
+# Compressions running at once, each ffmpeg gets an equal share of the CPUs so they don't oversubscribe them
+COMPRESSION_WORKERS = min(2, os.cpu_count() or 1)
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // COMPRESSION_WORKERS)
+
+# H.264 encoders: extra input options, video filter and encoder options. Libx264 runs on the CPU
+SOFTWARE_ENCODER = ("libx264", (), "scale=-2:720", ("-preset", "fast"))
+# Hardware encoders in order of preference, used when ffmpeg has them and a trial encode succeeds
+HARDWARE_ENCODERS = (
+    ("h264_nvenc", (), "hwupload_cuda,scale_cuda=-2:720", ("-preset", "p4", "-rc", "vbr")),
+    ("h264_amf", (), "scale=-2:720", ("-quality", "balanced", "-rc", "vbr_peak")),
+    ("h264_qsv", (), "scale=-2:720", ("-preset", "faster")),
+    ("h264_videotoolbox", (), "scale=-2:720", ()),
+    ("h264_vaapi", ("-vaapi_device", "/dev/dri/renderD128"), "format=nv12,hwupload,scale_vaapi=-2:720", ()),
+)
+# Serializes the encoder probe, compressions starting together would otherwise each run it
+encoder_lock = threading.Lock()
+
+# Seconds a whole download may take, like the timeout of the former yt-dlp subprocess, and seconds a
+# connection may stay silent before it is retried
+DOWNLOAD_TIMEOUT = 120
+SOCKET_TIMEOUT = 30
+
+# Options shared by every download, the output template and the deadline are added per call
+YDL_DOWNLOAD_OPTS = {
+    'format_sort': ['vcodec:h264', 'fps', 'res', 'acodec:m4a'],
+    'quiet': True,
+    'noprogress': True,
+    # Write straight to the final file, no .part file and rename
+    'nopart': True,
+    # Fetch large files in 10MB HTTP Range requests, some sites throttle a single long response
+    'http_chunk_size': 10 * 1024 * 1024,
+    'socket_timeout': SOCKET_TIMEOUT,
+    'logger': YtDlpLogger(),
+    **({'cookiefile': 'instagram_cookies.txt'} if INSTACOOKIES else {}),
+    **({'cachedir': YTDLP_CACHE_DIR} if YTDLP_CACHE_DIR else {}),
+}
+
+
+def preload_extractors():
+    """
+    Imports the yt-dlp extractors of the supported sites in a background thread.
+
+    yt-dlp loads extractor modules lazily on first use, so without this the first link of every
+    site pays for the import. Only the supported sites are loaded, importing all extractors would
+    cost far more memory than it saves time.
+    """
+
+    def load():
+        with yt_dlp.YoutubeDL({'quiet': True, 'logger': YtDlpLogger()}) as ydl:
+            for ie_key in PRELOADED_EXTRACTORS:
+                ydl.get_info_extractor(ie_key)
+        debug("Preloaded yt-dlp extractors: %s", ", ".join(PRELOADED_EXTRACTORS))
+
+    threading.Thread(target=load, name="yt-dlp-preload", daemon=True).start()
+
+
+@cached(metadata_cache, lock=metadata_lock)
 def get_video_metadata(url):
     """
     Extract metadata from a video URL without downloading the content.
 
+    Results are cached by URL for a few minutes, so a link posted again is not probed again.
+
     Args:
         url (str): The URL of the video to analyze
 
@@ -39,11 +145,15 @@ def get_video_metadata(url):
     ydl_opts = {
         'noplaylist': True,
         'quiet': True,
+        'logger': YtDlpLogger(),
+        **({'cachedir': YTDLP_CACHE_DIR} if YTDLP_CACHE_DIR else {}),
     }
     debug("Getting video metadata for: %s", url)
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         try:
-            info_dict = ydl.extract_info(url, download=False)  # fetch metadata only
+            # Processed, so every format carries the cookies set during extraction and the download can
+            # reuse the result in another YoutubeDL instance
+            info_dict = ydl.extract_info(url, download=False)
             debug("Video metadata extracted")
             return info_dict
         except (yt_dlp.utils.ExtractorError, yt_dlp.utils.DownloadError) as e:
@@ -54,23 +164,6 @@ def get_video_metadata(url):
             return None
 
 
-def is_video_duration_over_limits(video_path: str, max_duration: int = 720) -> bool:
-    """
-    Checks if the video file is of a suitable size for compression.
-
-    Args:
-        video_path (str): The path to the video file to check.
-        max_size_mb (int): The maximum file size in megabytes (default is 50MB).
-
-    Returns:
-        bool: True if the video file size is greater than the maximum size, False otherwise.
-    """
-    duration = get_video_duration(video_path)
-    if duration:
-        return duration > max_duration
-    return False
-
-
 def is_video_too_long_to_download(url, max_duration_minutes=12):
     """
     Checks if the video duration exceeds the specified maximum duration.
@@ -92,64 +185,226 @@ def is_video_too_long_to_download(url, max_duration_minutes=12):
     return False
 
 
-def compress_video(input_path):
+def get_h264_encoder():
+    """
+    Picks the H.264 encoder for compression, probed once on first use.
+
+    Returns:
+        tuple: Encoder name, extra input options, video filter and encoder options.
+    """
+    with encoder_lock:
+        return detect_h264_encoder()
+
+
+@lru_cache(maxsize=1)
+def detect_h264_encoder():
     """
-    Compress video for 50MB with use of FFmpeg.
+    Probes the H.264 encoders ffmpeg offers, see `get_h264_encoder`.
+
+    A hardware encoder can be listed by ffmpeg without a usable device behind it, so each one is
+    checked with a one-frame trial encode before it is picked.
+
+    Returns:
+        tuple: Encoder name, extra input options, video filter and encoder options.
+    """
+    try:
+        encoders = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        warning("Listing ffmpeg encoders failed, using %s: %s", SOFTWARE_ENCODER[0], e)
+        return SOFTWARE_ENCODER
+
+    for encoder in HARDWARE_ENCODERS:
+        name, input_options, video_filter, _ = encoder
+        if name not in encoders:
+            continue
+        trial = [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostdin",
+            *input_options,
+            "-f",
+            "lavfi",
+            "-i",
+            "color=size=256x256:rate=1",
+            "-frames:v",
+            "1",
+            "-vf",
+            video_filter,
+            "-c:v",
+            name,
+            "-f",
+            "null",
+            "-",
+        ]
+        try:
+            subprocess.run(trial, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=30)
+        except (OSError, subprocess.SubprocessError):
+            debug("Hardware encoder %s is not usable", name)
+            continue
+        debug("Using hardware encoder %s for compression", name)
+        return encoder
+
+    debug("No hardware encoder available, using %s for compression", SOFTWARE_ENCODER[0])
+    return SOFTWARE_ENCODER
+
+
+def compress_video(input_path, duration=None, max_size_mb=50):
+    """
+    Compress video to fit the upload limit with use of FFmpeg.
 
     Parameters:
         input_path (str): Path to original video.
+        duration (float): Duration of the video in seconds, probed with ffprobe if not given.
+        max_size_mb (int): The upload limit in megabytes (default is 50MB).
+
+    Returns:
+        int: Size of the video at `input_path` in bytes after compression.
     """
-    temp_output = tempfile.mktemp(suffix=".mp4")
-    # Caclulation of file size. 40 means MB
-    target_size_bytes = 40 * 1024 * 1024
-    duration = get_video_duration(input_path)
+    # Next to the input, so replacing it is a rename within the same file system
+    with tempfile.NamedTemporaryFile(suffix=".mp4", dir=os.path.dirname(input_path), delete=False) as temp_file:
+        temp_output = temp_file.name
+    # Caclulation of file size. Aim at 80% of the limit (40MB of 50MB), the bitrate is not exact
+    target_size_bytes = max_size_mb * 1024 * 1024 * 4 // 5
+    if not duration:
+        duration = get_video_duration(input_path)
     if not duration:
         raise ValueError("Get video duration failed.")
 
     # bitrate caclulation kb/s (bit/sec -> kb/sec)
     target_bitrate_kbps = (target_size_bytes * 8) / duration / 1000
+    encoder = get_h264_encoder()
     debug("Starting compression for video: %s", input_path)
 
+    try:
+        try:
+            run_compression(input_path, temp_output, target_bitrate_kbps, encoder)
+        except subprocess.CalledProcessError as e:
+            if encoder == SOFTWARE_ENCODER:
+                raise
+            # A hardware encoder that passed the trial can still fail on a real video (size, profile, device busy)
+            warning("Compressing with %s failed, retrying with %s: %s", encoder[0], SOFTWARE_ENCODER[0], e)
+            run_compression(input_path, temp_output, target_bitrate_kbps, SOFTWARE_ENCODER)
+        if os.path.exists(temp_output):
+            os.replace(temp_output, input_path)
+    except subprocess.CalledProcessError as e:
+        error("Error while compressing: %s", e)
+    debug("Compression completed for video: %s", input_path)
+    return os.stat(input_path).st_size
+
+
+def run_compression(input_path, output_path, bitrate_kbps, encoder):
+    """
+    Runs ffmpeg to re-encode a video with the given H.264 encoder.
+
+    Parameters:
+        input_path (str): Path to the original video.
+        output_path (str): Path to write the compressed video to, overwritten if it exists.
+        bitrate_kbps (float): Target video bitrate in kb/s.
+        encoder (tuple): Encoder name, extra input options, video filter and encoder options.
+
+    Raises:
+        subprocess.CalledProcessError: When ffmpeg fails.
+    """
+    name, input_options, video_filter, encoder_options = encoder
     command = [
         "nice",
         "-n",
         "19",
         "ffmpeg",
+        *input_options,
         "-i",
         input_path,
+        "-threads",
+        str(FFMPEG_THREADS),
+        "-filter_threads",
+        str(FFMPEG_THREADS),
         "-b:v",
-        f"{target_bitrate_kbps}k",
+        f"{bitrate_kbps}k",
         "-vf",
-        "scale=-2:720",
+        video_filter,
         "-c:v",
-        "libx264",
-        "-preset",
-        "fast",
+        name,
+        *encoder_options,
         "-c:a",
         "aac",
         "-b:a",
         "128k",
+        # Index at the start of the file, so Telegram clients can play the video while it loads
+        "-movflags",
+        "+faststart",
         "-y",
-        temp_output,
+        output_path,
     ]
+    subprocess.run(command, check=True)
+
+
+def get_mp4_duration(video_path):
+    """
+    Reads the duration of an MP4 file from its movie header box (moov/mvhd) without running ffprobe.
+
+    Only box headers are read, the media data is skipped over, so this costs a few small reads.
 
+    Args:
+        video_path (str): The path to the MP4 file.
+
+    Returns:
+        float: The duration in seconds, or None if the file has no usable movie header.
+    """
     try:
-        subprocess.run(command, check=True)
-        if os.path.exists(temp_output):
-            os.replace(temp_output, input_path)
-    except subprocess.CalledProcessError as e:
-        error("Error while compressing: %s", e)
-    debug("Compression completed for video: %s", input_path)
+        with open(video_path, "rb") as file:
+            end = os.fstat(file.fileno()).st_size
+            while file.tell() + 8 <= end:
+                start = file.tell()
+                size, box_type = struct.unpack(">I4s", file.read(8))
+                if size == 1:  # 64-bit size follows the type
+                    size = struct.unpack(">Q", file.read(8))[0]
+                elif size == 0:  # box extends to the end of the file
+                    size = end - start
+                if size < file.tell() - start:
+                    return None
+                if box_type == b"moov":
+                    # Continue with the boxes inside moov
+                    end = start + size
+                    continue
+                if box_type == b"mvhd":
+                    version = file.read(4)[0]
+                    if version == 1:
+                        file.seek(16, os.SEEK_CUR)  # 64-bit creation and modification times
+                        timescale, duration = struct.unpack(">IQ", file.read(12))
+                        unknown = 0xFFFFFFFFFFFFFFFF
+                    else:
+                        file.seek(8, os.SEEK_CUR)
+                        timescale, duration = struct.unpack(">II", file.read(8))
+                        unknown = 0xFFFFFFFF
+                    # Fragmented files keep no duration here
+                    if timescale and 0 < duration < unknown:
+                        return duration / timescale
+                    return None
+                file.seek(start + size)
+    except (OSError, struct.error, IndexError) as e:
+        debug("Reading MP4 duration failed for %s: %s", video_path, e)
+    return None
 
 
 def get_video_duration(video_path):
     """
     Gets video duration in seconds.
     """
+    if video_path.endswith(".mp4"):
+        duration = get_mp4_duration(video_path)
+        if duration:
+            return duration
+
     command = [
         "ffprobe",
         "-v",
-        "error",
+        "quiet",
         "-show_entries",
         "format=duration",
         "-of",
@@ -157,66 +412,153 @@ def get_video_duration(video_path):
         video_path,
     ]
     try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        return float(result.stdout.strip())
+        # float() parses the raw bytes, surrounding whitespace included, no decoding needed
+        return float(subprocess.check_output(command, stderr=subprocess.DEVNULL))
     except (subprocess.CalledProcessError, ValueError) as e:
         error("Error getting video duration: %s", e)
         return None
 
 
-def download_video(url):
+def extract_and_download(ydl, url):
+    """
+    Downloads a video, reusing the metadata extracted for the duration check when it is still cached.
+
+    Extracting a page again is the slowest part of a short download, so a cached single video info
+    dict is downloaded directly, the same way yt-dlp's `--load-info-json --no-clean-info-json` does.
+    If its format URLs have expired, the page is extracted again.
+
+    Parameters:
+        ydl (yt_dlp.YoutubeDL): The downloader configured with the download options.
+        url (str): The URL of the video to download.
+
+    Returns:
+        dict: The info dict of the downloaded video.
+    """
+    with metadata_lock:
+        info_dict = metadata_cache.get(hashkey(url))
+    if info_dict and info_dict.get('_type', 'video') == 'video':
+        try:
+            # A copy, processing fills in the dict and the cached one may be shared by another download
+            return ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+        except yt_dlp.utils.DownloadError as e:
+            debug("Downloading from cached metadata failed, extracting again: %s", e)
+    return ydl.extract_info(url, download=True)
+
+
+def download_video(url, temp_dir, max_duration=None):
     """
     Downloads a video from the specified URL using yt-dlp and saves it as an MP4 file.
 
-    This function uses the `yt-dlp` command-line tool to download a video. The video is stored
-    in a temporary directory with a filename based on the video's title. The function
-    returns the path to the downloaded video file if successful.
+    This function runs `yt-dlp` in-process through the `yt_dlp.YoutubeDL` API. The video is stored
+    in the given temporary directory with a filename based on the video's id. The function
+    returns the path to the downloaded video file if successful, along with the duration yt-dlp
+    reported for it, so the caller does not have to probe the file.
 
     Parameters:
         url (str): The URL of the video to download.
+        temp_dir (str): The directory to download the video to. The caller owns and removes it.
+        max_duration (int): Longest video to download in seconds, longer ones are skipped (default is no limit).
 
     Returns:
-        str: The path to the downloaded MP4 video file if successful, or None if the download fails.
+        tuple: The path to the downloaded MP4 video file, or None if the download fails or the video
+            is over `max_duration`, and the video duration in seconds, or None if yt-dlp did not report it.
 
     Exceptions:
-        Handles exceptions for subprocess errors, timeouts, or unexpected errors during the
+        Handles yt-dlp download/extractor errors and file system errors during the
         download process. Logs the errors if debugging is enabled.
     """
-    temp_dir = tempfile.mkdtemp()
-    command = [
-        "yt-dlp",  # Assuming yt-dlp is installed and in the PATH
-        *(["--cookies", "instagram_cookies.txt"] if INSTACOOKIES else []),
-        "-S",
-        "vcodec:h264,fps,res,acodec:m4a",
-        url,
-        "-o",
-        os.path.join(temp_dir, "%(id)s.%(ext)s"),
-    ]
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+
+    def check_deadline(progress):  # pylint: disable=unused-argument
+        # Called for every received chunk, stops a download that trickles along
+        if time.monotonic() > deadline:
+            # Not a DownloadError, the fragment downloader swallows those and would keep a truncated file
+            raise yt_dlp.utils.DownloadCancelled(f"Download took longer than {DOWNLOAD_TIMEOUT} seconds")
+
+    ydl_opts = {
+        **YDL_DOWNLOAD_OPTS,
+        'outtmpl': os.path.join(temp_dir, "%(id)s.%(ext)s"),
+        'progress_hooks': [check_deadline],
+    }
+    if max_duration:
+        # Skip longer videos in the same extraction, for when the duration probe had no answer
+        ydl_opts['match_filter'] = yt_dlp.utils.match_filter_func(f"duration <=? {max_duration}")
 
     debug("Downloading video from URL: %s", url)
     debug("Downloading video to temp_dir full path: %s", os.path.abspath(temp_dir))
-    result_path = temp_dir  # Initialize the result variable
+    result_path = None  # Initialize the result variable
+    duration = None
 
     try:
-        subprocess.run(command, check=True, timeout=120)
-        for filename in os.listdir(temp_dir):
-            if filename.endswith(".mp4"):
-                result_path = os.path.join(temp_dir, filename)
-                debug("Downloaded video found at path: %s", result_path)
-                break  # Exit the loop once the file is found
-    except subprocess.CalledProcessError as e:
-        error("Error downloading video: %s", e)
-    except subprocess.TimeoutExpired as e:
-        error("Download process timed out: %s", e)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info_dict = extract_and_download(ydl, url)
+        duration = info_dict.get('duration')
+        # yt-dlp reports the final (post-merge) path of a single video, playlists have no such entry
+        requested_downloads = info_dict.get('requested_downloads') or [{}]
+        filepath = requested_downloads[0].get('filepath')
+        if filepath and filepath.endswith(".mp4") and os.path.exists(filepath):
+            result_path = filepath
+            debug("Downloaded video found at path: %s", result_path)
+        else:
+            with os.scandir(temp_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".mp4"):
+                        result_path = entry.path
+                        debug("Downloaded video found at path: %s", result_path)
+                        break  # Exit the loop once the file is found
     except (OSError, IOError) as e:
         debug("Downloading video from URL: %s", url)
         error("File system error occurred: %s", e)
     except yt_dlp.utils.DownloadError as e:
         error("Download error occurred: %s", e)
+    except yt_dlp.utils.DownloadCancelled as e:
+        error("Download cancelled: %s", e)
     except yt_dlp.utils.ExtractorError as e:
         error("Extractor error occurred: %s", e)
 
-    return result_path  # Return the result variable at the end
+    return result_path, duration  # Return the result variables at the end
+
+
+def create_temp_dir():
+    """
+    Creates a temporary directory for a single download.
+
+    Returns:
+        str: The path to the new directory.
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=DOWNLOAD_DIR)
+
+
+def cleanup_orphaned_temp_dirs(max_age, keep=frozenset()):
+    """
+    Removes download directories left behind by a download that never cleaned up, e.g. a killed run.
+
+    Directories are matched by `TEMP_DIR_PREFIX` in the bot's own `DOWNLOAD_DIR`.
+
+    Parameters:
+        max_age (float): Only remove directories not modified for this many seconds. Keep it well above
+            `DOWNLOAD_TIMEOUT`, another bot instance sharing the directory may still be downloading.
+        keep (frozenset): Paths of directories still in use by this process, never removed.
+    """
+    now = time.time()
+    try:
+        entries = os.scandir(DOWNLOAD_DIR)
+    except FileNotFoundError:
+        return  # Nothing was downloaded yet
+    with entries:
+        for entry in entries:
+            if not entry.name.startswith(TEMP_DIR_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.path in keep:
+                continue
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                    continue
+            except FileNotFoundError:
+                continue  # Removed by its own download in the meantime
+            debug("Removing orphaned temporary directory: %s", entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
 
 
 def cleanup(video_path):
@@ -241,10 +583,14 @@ def cleanup(video_path):
         debug("Temporary directory is not empty: %s", os.path.dirname(video_path))
         temp_dir = os.path.dirname(video_path)
     try:
-        shutil.rmtree(temp_dir)
-        if os.path.exists(video_path):
-            error("Temporary directory still exists after cleanup: %s", video_path)
-        else:
-            debug("Temporary directory successfully deleted: %s", video_path)
+        # A download directory holds a few plain files, unlinked straight from the directory listing
+        with os.scandir(temp_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+        os.rmdir(temp_dir)
+        debug("Temporary directory successfully deleted: %s", video_path)
     except (OSError, IOError) as cleanup_error:
         error("Error deleting file: %s", cleanup_error)